@@ -5,117 +5,401 @@ Only handles PDF files from the ESG_docs folder.
 """
 
 import os
+import argparse
+import asyncio
 import hashlib
+import json
+import multiprocessing
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from pathlib import Path
-from datetime import datetime
-from typing import List, Dict, Any
-import gc
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Deque, Iterable, Iterator, Tuple
 from dotenv import load_dotenv
+import numpy as np
 import tiktoken
 
 from azure.search.documents import SearchClient
 from azure.core.credentials import AzureKeyCredential
-from openai import AzureOpenAI
-import PyPDF2
+from openai import AsyncAzureOpenAI, AzureOpenAI, RateLimitError
+import fitz  # PyMuPDF
 
 load_dotenv()
 
-def extract_pdf_content(pdf_path: Path) -> str:
-    """Extract text from all pages of a PDF file"""
+# Embeddings requests are sized by total tokens (~10 800-token chunks each), capped
+# at the 2048 inputs the API accepts per request
+EMBEDDING_BATCH_TOKENS = 8192
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_CONCURRENCY = 10  # embeddings requests in flight at once, across all files
+EMBEDDING_FILES_IN_FLIGHT = 8  # files being embedded concurrently
+EMBEDDING_MAX_RETRIES = 5  # retries of a rate-limited request, on top of the SDK's own
+
+# Documents per upload request. Each 3072-dim vector is ~60 KB of JSON, so
+# 100 documents keeps a request well under Azure AI Search's 16 MB limit.
+UPLOAD_BATCH_SIZE = 100
+UPLOAD_WORKERS = 8  # concurrent upload requests
+MAX_PENDING_UPLOADS = UPLOAD_WORKERS * 2  # queued batches before main waits (bounds memory)
+
+# Vector components are rounded before upload to shrink the JSON payload;
+# the index quantizes them to int8 anyway (see azure-index-schema.json)
+VECTOR_DECIMALS = 6
+
+# Local cache of chunk embeddings so unchanged chunks are not re-embedded
+EMBEDDING_CACHE_PATH = "embed_cache.sqlite"
+
+# Extracted PDF pages, keyed by path/mtime/size so changed files are re-read
+PDF_TEXT_CACHE_DIR = Path(".cache/pdf_text")
+
+# Batch API job settings (used with --batch)
+BATCH_INPUT_PATH = "embeddings.jsonl"
+BATCH_POLL_INTERVAL = 60  # seconds between status checks
+
+# Filename keywords used by get_esg_metadata, grouped by what they indicate.
+# They are matched against whole filename words, so 'gri' does not hit 'integrity'.
+_COMPANIES = ("microsoft", "apple", "google", "amazon", "tesla", "nvidia", "meta")
+_KEYWORD_GROUPS = {
+    'gri': frozenset({"gri"}),
+    'sasb': frozenset({"sasb"}),
+    'tcfd': frozenset({"tcfd"}),
+    'report': frozenset({"sustainability", "esg"}),
+    'climate': frozenset({"climate"}),
+    'environmental': frozenset({"carbon", "environment", "environmental", "green"}),
+    'social': frozenset({"diversity", "social", "inclusion", "community"}),
+    'governance': frozenset({"governance", "board", "ethics", "compliance"}),
+}
+_FILENAME_SPLIT_RE = re.compile(r'[^a-z]+')  # filename is lowercased first
+_YEAR_RE = re.compile(r'20\d{2}')
+
+# Building the BPE tables is expensive, so share one encoder for all chunking
+_ENCODER = tiktoken.encoding_for_model("gpt-4")
+
+@lru_cache(maxsize=None)
+def get_search_client(index_name: str) -> SearchClient:
+    """Return a shared Azure AI Search client for the given index.
+    
+    One client is shared by all upload threads. Its default transport keeps a
+    single keep-alive session whose pool (10 connections) already covers
+    UPLOAD_WORKERS.
+    """
+    return SearchClient(
+        endpoint=os.getenv('AZURE_SEARCH_ENDPOINT'),
+        index_name=index_name,
+        credential=AzureKeyCredential(os.getenv('AZURE_SEARCH_KEY'))
+    )
+
+@lru_cache(maxsize=None)
+def get_openai_client() -> AzureOpenAI:
+    """Return a shared Azure OpenAI client for the embeddings deployment"""
+    return AzureOpenAI(
+        azure_endpoint=os.getenv('AZURE_OPENAI_EMBEDDINGS_ENDPOINT'),
+        api_key=os.getenv('AZURE_OPENAI_EMBEDDINGS_API_KEY'),
+        api_version=os.getenv('AZURE_OPENAI_API_VERSION', '2024-02-01')
+    )
+
+@lru_cache(maxsize=None)
+def get_async_openai_client() -> AsyncAzureOpenAI:
+    """Return a shared async Azure OpenAI client for concurrent embedding requests"""
+    return AsyncAzureOpenAI(
+        azure_endpoint=os.getenv('AZURE_OPENAI_EMBEDDINGS_ENDPOINT'),
+        api_key=os.getenv('AZURE_OPENAI_EMBEDDINGS_API_KEY'),
+        api_version=os.getenv('AZURE_OPENAI_API_VERSION', '2024-02-01')
+    )
+
+def stream_pages(pdf_path: Path) -> Iterator[str]:
+    """Yield the text of each non-empty page of a PDF file"""
     print(f"📄 Extracting PDF content from: {pdf_path.name}")
     
+    with fitz.open(str(pdf_path)) as doc:
+        if doc.page_count == 0:
+            print("⚠️ PDF has no pages")
+            return
+        
+        print(f"📊 Processing {doc.page_count} pages...")
+        
+        total_chars = 0
+        for page in doc:
+            page_text = page.get_text("text")
+            if page_text.strip():
+                total_chars += len(page_text)
+                yield page_text
+        
+        print(f"✅ Extracted {total_chars} characters from {doc.page_count} pages")
+
+def stream_pages_cached(pdf_path: Path) -> Iterator[str]:
+    """Yield the PDF's pages from the local text cache, extracting (and caching) on a miss"""
+    stat = pdf_path.stat()
+    key = hashlib.sha256(f"{pdf_path}|{stat.st_mtime_ns}|{stat.st_size}".encode()).hexdigest()
+    cache_file = PDF_TEXT_CACHE_DIR / f"{key}.jsonl"
+    
+    if cache_file.exists():
+        print(f"💾 Using cached text for: {pdf_path.name}")
+        with open(cache_file, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+        return
+    
+    # One JSON string per line lets cached pages be read back one at a time.
+    # Pages go to a temp file that is only renamed into place once the whole
+    # PDF has been read, so errors and crashes never leave a partial entry.
+    # Caching is best effort: if it fails, pages are still extracted and indexed.
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
     try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            
-            if len(pdf_reader.pages) == 0:
-                print("⚠️ PDF has no pages")
-                return ""
-            
-            pages_to_process = len(pdf_reader.pages)
-            print(f"📊 Processing {pages_to_process} pages...")
-            
-            text = ""
-            for page_num in range(pages_to_process):
+        PDF_TEXT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_out = open(tmp_file, 'w', encoding='utf-8')
+    except OSError as e:
+        print(f"⚠️ Warning: Could not cache extracted text: {e}")
+        yield from stream_pages(pdf_path)
+        return
+    
+    try:
+        caching = True
+        pages_written = 0
+        for page_text in stream_pages(pdf_path):
+            if caching:
                 try:
-                    page = pdf_reader.pages[page_num]
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-                    
-                    # Progress indicator every 10 pages
-                    if (page_num + 1) % 10 == 0:
-                        print(f"   📄 Processed {page_num + 1}/{pages_to_process} pages")
-                        gc.collect()  # Memory cleanup
-                        
-                except Exception as e:
-                    print(f"⚠️ Warning: Could not extract page {page_num + 1}: {e}")
-            
-            print(f"✅ Extracted {len(text)} characters from {pages_to_process} pages")
-            return text.strip()
-            
-    except Exception as e:
-        print(f"❌ Error extracting PDF: {e}")
-        return ""
+                    cache_out.write(json.dumps(page_text) + "\n")
+                    pages_written += 1
+                except OSError as e:
+                    print(f"⚠️ Warning: Could not cache extracted text: {e}")
+                    caching = False
+            yield page_text
+        
+        cache_out.close()
+        if caching and pages_written:
+            try:
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                print(f"⚠️ Warning: Could not cache extracted text: {e}")
+    finally:
+        cache_out.close()
+        try:
+            tmp_file.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"⚠️ Warning: Could not remove temporary cache file: {e}")
 
-def chunk_text(text: str, max_tokens: int = 800, overlap: int = 150) -> List[str]:
-    """Split text into overlapping chunks for better embedding performance"""
-    print(f"🔧 Chunking text into {max_tokens}-token pieces with {overlap}-token overlap...")
+def stream_chunks(pages: Iterable[str], max_tokens: int = 800,
+                  overlap: int = 150) -> Iterator[np.ndarray]:
+    """Split a stream of page texts into overlapping token-id windows.
+    
+    Pages are encoded one at a time into a rolling buffer, and a window is
+    emitted as soon as the buffer holds max_tokens tokens, keeping the last
+    `overlap` tokens for the next one. Memory stays bounded by one page plus
+    one window regardless of document length.
+    """
+    step = max_tokens - overlap
+    buffer: List[int] = []
+    emitted = False
+    
+    for page_text in pages:
+        buffer.extend(_ENCODER.encode(page_text + "\n"))
+        while len(buffer) >= max_tokens:
+            yield np.array(buffer[:max_tokens], dtype=np.int32)
+            emitted = True
+            del buffer[:step]
+    
+    # Emit the tail unless it is only overlap already covered by the last window
+    if len(buffer) > (overlap if emitted else 0):
+        yield np.array(buffer, dtype=np.int32)
+
+async def get_embeddings_batch(token_windows: List[List[int]], openai_client, model: str,
+                               semaphore: asyncio.Semaphore) -> List[List[float]]:
+    """Generate embeddings for a batch of token-id windows in a single Azure OpenAI request.
+    
+    Rate-limited requests are retried with exponential backoff. The semaphore slot
+    is held while backing off, so a throttled deployment also slows the other requests.
+    """
+    async with semaphore:
+        print(f"🔄 Generating embeddings for {len(token_windows)} chunks...")
+        for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+            try:
+                response = await openai_client.embeddings.create(
+                    input=token_windows,
+                    model=model
+                )
+                print("✅ Embeddings generated successfully")
+                return [d.embedding for d in response.data]
+            except RateLimitError as e:
+                if attempt == EMBEDDING_MAX_RETRIES:
+                    print(f"❌ Error generating embeddings: still rate limited after {attempt} retries: {e}")
+                    return []
+                delay = 2 ** (attempt + 1)
+                print(f"⏳ Rate limited - retrying in {delay}s")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                print(f"❌ Error generating embeddings: {e}")
+                return []
+
+def open_embedding_cache(cache_path: str = EMBEDDING_CACHE_PATH) -> sqlite3.Connection:
+    """Open (and create if needed) the on-disk embedding cache"""
+    # Used from the embedding event-loop thread as well as main; access is never concurrent
+    cache = sqlite3.connect(cache_path, check_same_thread=False)
+    cache.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB)")
+    return cache
+
+def _embedding_cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{text}".encode()).digest()
+
+def _load_cached_embeddings(cache: sqlite3.Connection, keys: List[bytes]) -> Dict[bytes, List[float]]:
+    cached = {}
+    # Query in slices to stay under SQLite's bound-parameter limit
+    for start in range(0, len(keys), 500):
+        key_slice = keys[start:start + 500]
+        placeholders = ",".join("?" * len(key_slice))
+        rows = cache.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", key_slice)
+        for key, vec in rows:
+            vector = array('f')
+            vector.frombytes(vec)
+            cached[key] = vector.tolist()
+    return cached
+
+def _store_cached_embeddings(cache: sqlite3.Connection, rows: List[Tuple[bytes, List[float]]]):
+    cache.executemany(
+        "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+        [(key, array('f', vector).tobytes()) for key, vector in rows]
+    )
+    cache.commit()
+
+def _batch_by_tokens(items: List[Tuple[bytes, np.ndarray]]) -> List[List[Tuple[bytes, np.ndarray]]]:
+    """Group (key, window) pairs into request batches of at most EMBEDDING_BATCH_TOKENS tokens"""
+    batches = []
+    batch: List[Tuple[bytes, np.ndarray]] = []
+    batch_tokens = 0
+    for key, window in items:
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE
+                      or batch_tokens + len(window) > EMBEDDING_BATCH_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append((key, window))
+        batch_tokens += len(window)
+    if batch:
+        batches.append(batch)
+    return batches
+
+async def _create_semaphore(value: int) -> asyncio.Semaphore:
+    # Created inside the event loop so it binds to that loop on older Pythons
+    return asyncio.Semaphore(value)
+
+async def get_cached_embeddings(texts: List[str], windows: List[np.ndarray], openai_client,
+                                model: str, cache: sqlite3.Connection,
+                                semaphore: asyncio.Semaphore) -> List[List[float]]:
+    """Embed chunks, only calling Azure OpenAI for chunks not already cached.
+    
+    Chunks are cached by text but embedded from their token-id windows. Uncached
+    chunks are sent in batches of up to EMBEDDING_BATCH_TOKENS tokens; `semaphore` is shared by
+    every file being embedded, so it bounds requests in flight across files.
+    Returns one vector per input; chunks whose embedding failed get an empty list.
+    """
+    keys = [_embedding_cache_key(model, text) for text in texts]
+    cached = _load_cached_embeddings(cache, keys)
+    
+    # Only send chunks we have not seen before (deduplicated within the file too)
+    uncached = {}
+    for key, window in zip(keys, windows):
+        if key not in cached:
+            uncached.setdefault(key, window)
+    
+    cache_hits = sum(key in cached for key in keys)
+    if cache_hits:
+        print(f"💾 {cache_hits}/{len(texts)} embeddings found in cache")
+    
+    if uncached:
+        batches = _batch_by_tokens(list(uncached.items()))
+        results = await asyncio.gather(*(
+            get_embeddings_batch([window.tolist() for _, window in batch], openai_client, model, semaphore)
+            for batch in batches
+        ))
+        
+        new_rows = []
+        for batch, batch_embeddings in zip(batches, results):
+            if len(batch_embeddings) == len(batch):
+                new_rows.extend(zip((key for key, _ in batch), batch_embeddings))
+        _store_cached_embeddings(cache, new_rows)
+        cached.update(new_rows)
+    
+    return [cached.get(key, []) for key in keys]
+
+def get_embeddings_via_batch_api(texts: List[str], windows: List[np.ndarray], openai_client,
+                                 model: str, cache: sqlite3.Connection) -> List[List[float]]:
+    """Embed chunks with an Azure OpenAI Batch API job instead of synchronous calls.
+    
+    Cached chunks are left out of the job. Blocks until the job finishes and
+    returns one vector per input; chunks whose embedding failed get an empty list.
+    """
+    keys = [_embedding_cache_key(model, text) for text in texts]
+    cached = _load_cached_embeddings(cache, keys)
+    print(f"💾 {sum(key in cached for key in keys)}/{len(texts)} embeddings found in cache")
+    
+    # One request per distinct uncached chunk; the cache key doubles as custom_id
+    uncached = {}
+    for key, window in zip(keys, windows):
+        if key not in cached:
+            uncached.setdefault(key.hex(), window)
+    
+    if not uncached:
+        return [cached[key] for key in keys]
     
     try:
-        tokenizer = tiktoken.encoding_for_model("gpt-4")
-        tokens = tokenizer.encode(text)
+        with open(BATCH_INPUT_PATH, 'w', encoding='utf-8') as f:
+            for custom_id, window in uncached.items():
+                request = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {"model": model, "input": window.tolist()}
+                }
+                f.write(json.dumps(request) + "\n")
+        print(f"📝 Wrote {len(uncached)} embedding requests to {BATCH_INPUT_PATH}")
         
-        print(f"📊 Total tokens to process: {len(tokens)}")
+        with open(BATCH_INPUT_PATH, 'rb') as f:
+            batch_file = openai_client.files.create(file=f, purpose="batch")
         
-        if len(tokens) <= max_tokens:
-            print(f"✅ Text fits in single chunk ({len(tokens)} tokens)")
-            return [text]
+        batch_job = openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h"
+        )
+        print(f"🚀 Submitted batch job {batch_job.id}")
         
-        chunks = []
-        start = 0
-        chunk_num = 0
-        max_chunks = 1000  # Reasonable limit for PDF documents
+        while batch_job.status not in ("completed", "failed", "expired", "cancelled"):
+            print(f"⏳ Batch job status: {batch_job.status} - checking again in {BATCH_POLL_INTERVAL}s")
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch_job = openai_client.batches.retrieve(batch_job.id)
         
-        while start < len(tokens) and chunk_num < max_chunks:
-            end = min(start + max_tokens, len(tokens))
-            chunk_tokens = tokens[start:end]
-            chunk_text = tokenizer.decode(chunk_tokens)
-            chunks.append(chunk_text)
-            
-            chunk_num += 1
-            if chunk_num % 25 == 0:  # Progress every 25 chunks
-                print(f"   🔧 Created {chunk_num} chunks... ({start}/{len(tokens)} tokens)")
-                gc.collect()
-            
-            # Move start with overlap
-            start = end - overlap
-            if start >= len(tokens):
-                break
+        if batch_job.status != "completed" or not batch_job.output_file_id:
+            print(f"❌ Batch job {batch_job.id} ended with status: {batch_job.status}")
+            return [cached.get(key, []) for key in keys]
         
-        if chunk_num >= max_chunks:
-            print(f"⚠️ WARNING: Hit chunk limit of {max_chunks}. Document truncated.")
+        new_rows = []
+        failed = 0
+        output = openai_client.files.content(batch_job.output_file_id)
+        for line in output.iter_lines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                failed += 1
+                continue
+            vector = response["body"]["data"][0]["embedding"]
+            new_rows.append((bytes.fromhex(result["custom_id"]), vector))
         
-        print(f"✅ Created {len(chunks)} chunks total")
-        return chunks
+        _store_cached_embeddings(cache, new_rows)
+        cached.update(new_rows)
+        print(f"✅ Batch job returned {len(new_rows)} embeddings ({failed} failed)")
         
     except Exception as e:
-        print(f"❌ Error chunking text: {e}")
-        return [text]  # Return original text as fallback
-
-def get_embeddings(text: str, openai_client, model: str) -> List[float]:
-    """Generate embeddings for text using Azure OpenAI"""
-    try:
-        print(f"🔄 Generating embeddings for {len(text)} characters...")
-        response = openai_client.embeddings.create(
-            input=text,
-            model=model
-        )
-        print("✅ Embeddings generated successfully")
-        return response.data[0].embedding
-    except Exception as e:
-        print(f"❌ Error generating embeddings: {e}")
-        return []
+        print(f"❌ Error running batch embedding job: {e}")
+    
+    return [cached.get(key, []) for key in keys]
 
 def get_esg_metadata(file_path: Path) -> Dict[str, Any]:
     """Extract ESG-specific metadata from filename patterns"""
@@ -129,54 +413,194 @@ def get_esg_metadata(file_path: Path) -> Dict[str, Any]:
         'tags': 'esg,sustainability'
     }
     
+    # Split the filename into words once; every keyword check is then a set lookup
+    tokens = set(_FILENAME_SPLIT_RE.split(filename))
+    found = {group for group, terms in _KEYWORD_GROUPS.items() if not terms.isdisjoint(tokens)}
+    company = next((c for c in _COMPANIES if c in tokens), None)
+    
     # ESG Frameworks
-    if 'gri' in filename:
+    if 'gri' in found:
         metadata['institution'] = 'Global Reporting Initiative'
         metadata['document_type'] = 'GRI Standards'
         metadata['tags'] = 'gri,standards,sustainability,reporting'
-    elif 'sasb' in filename:
+    elif 'sasb' in found:
         metadata['institution'] = 'Sustainability Accounting Standards Board'
         metadata['document_type'] = 'SASB Standards'
         metadata['tags'] = 'sasb,standards,sustainability,accounting'
-    elif 'tcfd' in filename:
+    elif 'tcfd' in found:
         metadata['institution'] = 'Task Force on Climate-related Financial Disclosures'
         metadata['document_type'] = 'TCFD Framework'
         metadata['tags'] = 'tcfd,climate,risk,disclosure'
     
     # Corporate ESG Reports
-    elif any(company in filename for company in ['microsoft', 'apple', 'google', 'amazon', 'tesla', 'nvidia', 'meta']):
-        for company in ['microsoft', 'apple', 'google', 'amazon', 'tesla', 'nvidia', 'meta']:
-            if company in filename:
-                metadata['institution'] = company.title()
-                break
+    elif company is not None:
+        metadata['institution'] = company.title()
         
-        if 'sustainability' in filename or 'esg' in filename:
+        if 'report' in found:
             metadata['document_type'] = 'Corporate ESG Report'
             metadata['tags'] = 'corporate,esg,sustainability,report'
-        elif 'climate' in filename:
+        elif 'climate' in found:
             metadata['document_type'] = 'Climate Report'
             metadata['tags'] = 'climate,corporate,environmental'
     
     # Topic-based categorization
-    elif any(term in filename for term in ['climate', 'carbon', 'environment', 'green']):
+    elif 'climate' in found or 'environmental' in found:
         metadata['document_type'] = 'Environmental Report'
         metadata['tags'] = 'environmental,climate,carbon,green'
-    elif any(term in filename for term in ['diversity', 'social', 'inclusion', 'community']):
+    elif 'social' in found:
         metadata['document_type'] = 'Social Impact Report'
         metadata['tags'] = 'social,diversity,inclusion,community'
-    elif any(term in filename for term in ['governance', 'board', 'ethics', 'compliance']):
+    elif 'governance' in found:
         metadata['document_type'] = 'Governance Report'
         metadata['tags'] = 'governance,ethics,compliance,board'
     
     # Extract year from filename
-    import re
-    year_match = re.search(r'20\d{2}', filename)
+    year_match = _YEAR_RE.search(filename)
     if year_match:
         metadata['year'] = int(year_match.group())
     
     return metadata
 
+def build_file_documents(file_path: Path, metadata: Dict[str, Any], chunks: List[str],
+                         chunk_embeddings: List[List[float]]) -> List[Dict[str, Any]]:
+    """Build the index documents for one PDF from its chunks and their embeddings"""
+    total = len(chunks)
+    # One UTC timestamp per file (it is serialized with a 'Z' suffix)
+    created_date = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    fname = file_path.name
+    file_path_str = str(file_path)
+    file_size = file_path.stat().st_size
+    
+    # Process each chunk
+    file_documents = []
+    for i, (chunk, embeddings) in enumerate(zip(chunks, chunk_embeddings)):
+        print(f"🔄 Processing chunk {i+1}/{total}...")
+        
+        # Generate unique ID
+        chunk_suffix = f"_chunk{i}" if total > 1 else "_single"
+        doc_id = hashlib.md5(f"{fname}{chunk_suffix}".encode()).hexdigest()
+        
+        if not embeddings:
+            print(f"⚠️ Skipping chunk {i+1} - no embeddings generated")
+            continue
+        
+        # Create document for index
+        if total > 1:
+            title_suffix = f" (Part {i+1}/{total})"
+            summary = f"Part {i+1} of {total} from {fname}"
+        else:
+            title_suffix = ""
+            summary = f"Complete content from {fname}"
+        
+        document = {
+            'id': doc_id,
+            'title': f"{fname}{title_suffix}",
+            'content': chunk,
+            'summary': summary,
+            'document_type': metadata['document_type'],
+            'institution': metadata['institution'], 
+            'year': metadata['year'],
+            'file_format': 'PDF',
+            'tags': metadata['tags'],
+            'chunk_index': i,
+            'total_chunks': total,
+            'file_path': file_path_str,
+            'file_size': file_size,
+            'created_date': created_date,
+            # approximate word count; PyMuPDF ends every line with a newline
+            'relevance_score': (chunk.count(" ") + chunk.count("\n") + 1) / 1000.0,
+            'content_vector': [round(x, VECTOR_DECIMALS) for x in embeddings]
+        }
+        
+        file_documents.append(document)
+        print(f"✅ Created document for chunk {i+1}")
+    
+    return file_documents
+
+def upload_document_batch(search_client: SearchClient, batch: List[Dict[str, Any]],
+                          batch_num: int, total_batches: int) -> int:
+    """Upload one batch of documents and return how many succeeded"""
+    print(f"📤 Uploading batch {batch_num}/{total_batches} ({len(batch)} chunks)...")
+    
+    try:
+        result = search_client.upload_documents(documents=batch)
+        
+        success_count = sum(1 for r in result if r.succeeded)
+        error_count = len(batch) - success_count
+        
+        if error_count > 0:
+            print(f"⚠️ Batch {batch_num}: {success_count} succeeded, {error_count} failed")
+            for r in result:
+                if not r.succeeded:
+                    print(f"   ❌ Error: {r.error_message}")
+        else:
+            print(f"✅ Batch {batch_num}: All {success_count} chunks uploaded successfully")
+        
+        return success_count
+        
+    except Exception as e:
+        print(f"❌ Error uploading batch {batch_num}: {e}")
+        return 0
+
+def submit_document_uploads(upload_executor: ThreadPoolExecutor, search_client: SearchClient,
+                            documents: List[Dict[str, Any]]) -> List[Future]:
+    """Queue documents for upload in batches on the shared upload pool without waiting"""
+    batch_size = UPLOAD_BATCH_SIZE
+    total_batches = (len(documents) + batch_size - 1) // batch_size
+    
+    print(f"📤 Queueing {len(documents)} document chunks for upload...")
+    
+    return [
+        upload_executor.submit(
+            upload_document_batch, search_client,
+            documents[i:i + batch_size], (i // batch_size) + 1, total_batches
+        )
+        for i in range(0, len(documents), batch_size)
+    ]
+
+def collect_uploads(pending: List[Future], max_pending: int = 0) -> int:
+    """Wait until at most max_pending uploads are outstanding.
+    
+    Finished futures are removed from `pending`; returns how many documents they uploaded.
+    """
+    uploaded = 0
+    while len(pending) > max_pending:
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        uploaded += sum(future.result() for future in done)
+        pending[:] = list(not_done)
+    return uploaded
+
+def process_pdf(path_str: str) -> Tuple[Dict[str, Any], List[str], List[np.ndarray], Path]:
+    """Extract, classify and chunk a single PDF (runs inside a worker process).
+    
+    Returns the chunk texts together with their token-id windows, which are
+    sent to the embeddings endpoint as-is so the text is never re-tokenized.
+    """
+    file_path = Path(path_str)
+    metadata = get_esg_metadata(file_path)
+    
+    max_tokens, overlap = 800, 150
+    print(f"🔧 Chunking text into {max_tokens}-token pieces with {overlap}-token overlap...")
+    
+    try:
+        windows = list(stream_chunks(stream_pages_cached(file_path), max_tokens, overlap))
+        chunks = _ENCODER.decode_batch([window.tolist() for window in windows])
+    except Exception as e:
+        print(f"❌ Error processing PDF {file_path.name}: {e}")
+        return metadata, [], [], file_path
+    
+    print(f"✅ Created {len(chunks)} chunks total")
+    return metadata, chunks, windows, file_path
+
 def main():
+    parser = argparse.ArgumentParser(description="Index ESG PDF documents in Azure AI Search")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Embed all chunks with a single Azure OpenAI Batch API job (cheaper, slower; for initial builds)"
+    )
+    args = parser.parse_args()
+    
     print("🚀 Indexing ESG PDF Documents in Azure AI Search")
     print("=" * 60)
     
@@ -201,17 +625,9 @@ def main():
     print("🔧 Initializing Azure clients...")
     
     # Initialize clients
-    search_client = SearchClient(
-        endpoint=os.getenv('AZURE_SEARCH_ENDPOINT'),
-        index_name=INDEX_NAME,
-        credential=AzureKeyCredential(os.getenv('AZURE_SEARCH_KEY'))
-    )
-    
-    openai_client = AzureOpenAI(
-        azure_endpoint=os.getenv('AZURE_OPENAI_EMBEDDINGS_ENDPOINT'),
-        api_key=os.getenv('AZURE_OPENAI_EMBEDDINGS_API_KEY'),
-        api_version=os.getenv('AZURE_OPENAI_API_VERSION', '2024-02-01')
-    )
+    search_client = get_search_client(INDEX_NAME)
+    openai_client = get_openai_client()
+    async_openai_client = get_async_openai_client()
     
     embedding_model = os.getenv('AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME', 'text-embedding-3-large')
     
@@ -222,7 +638,7 @@ def main():
         return
     
     # Find all PDF files
-    pdf_files = list(ESG_DATA_DIR.glob("*.pdf"))
+    pdf_files = sorted(ESG_DATA_DIR.glob("*.pdf"))
     
     if not pdf_files:
         print(f"❌ No PDF files found in {ESG_DATA_DIR}")
@@ -232,146 +648,206 @@ def main():
     for i, file_path in enumerate(pdf_files, 1):
         print(f"   {i:2d}. {file_path.name}")
     
+    embedding_cache = open_embedding_cache()
+    # One event loop for the whole run, kept running in a background thread so
+    # embedding requests progress while the next PDF is still being extracted
+    embedding_loop = asyncio.new_event_loop()
+    embedding_thread = threading.Thread(target=embedding_loop.run_forever, daemon=True)
+    embedding_thread.start()
+    embedding_semaphore = asyncio.run_coroutine_threadsafe(
+        _create_semaphore(EMBEDDING_CONCURRENCY), embedding_loop
+    ).result()
+    
     print(f"\n🔄 Starting PDF processing...")
     
-    all_documents = []
     processed_files = 0
+    total_documents = 0
+    total_uploaded = 0
+    total_skipped = 0  # chunks left out because their embedding failed
+    pending_files = []  # (file_path, metadata, chunks, windows) waiting on the batch job
     
-    for file_index, file_path in enumerate(pdf_files, 1):
-        print(f"\n{'='*60}")
-        print(f"📄 Processing {file_index}/{len(pdf_files)}: {file_path.name}")
-        print(f"{'='*60}")
+    # One upload pool for the whole run, so batches from consecutive files overlap
+    upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    upload_futures: List[Future] = []
+    embedding_futures: Dict[Future, Tuple[Path, Dict[str, Any], List[str]]] = {}
+    
+    def finish_embedded_file(future: Future):
+        """Build and queue uploads for a file whose embeddings have finished"""
+        nonlocal processed_files, total_documents, total_uploaded, total_skipped
+        file_path, metadata, chunks = embedding_futures.pop(future)
         
         try:
-            # Extract text from PDF
-            text = extract_pdf_content(file_path)
-            if not text:
-                print(f"⚠️ Skipping {file_path.name} - no text extracted")
-                continue
+            chunk_embeddings = future.result()
             
-            print(f"📝 Total text length: {len(text)} characters")
+            # Queue this file's chunks for upload straight away rather than holding
+            # every embedding for the whole corpus in memory
+            file_documents = build_file_documents(file_path, metadata, chunks, chunk_embeddings)
+            upload_futures.extend(submit_document_uploads(upload_executor, search_client, file_documents))
+            total_documents += len(file_documents)
+            total_skipped += len(chunks) - len(file_documents)
+            processed_files += 1
             
-            # Get document metadata
-            metadata = get_esg_metadata(file_path)
-            print(f"🏷️ Classified as: {metadata['document_type']} from {metadata['institution']}")
+            print(f"✅ Completed {file_path.name}: {len(file_documents)} chunks queued for upload")
+            print(f"📊 Progress: {processed_files}/{len(pdf_files)} files processed")
+            del file_documents, chunk_embeddings
             
-            # Chunk the text
-            chunks = chunk_text(text, max_tokens=800, overlap=150)
-            print(f"📦 Created {len(chunks)} chunks for processing")
+        except Exception as e:
+            print(f"❌ Error processing {file_path.name}: {e}")
+        
+        total_uploaded += collect_uploads(upload_futures, MAX_PENDING_UPLOADS)
+    
+    # PDF extraction and chunking is CPU-bound, so fan it out over worker
+    # processes; embeddings and uploads stay in this process.
+    max_workers = min(os.cpu_count() or 1, 4)
+    print(f"⚙️ Extracting PDFs with {max_workers} worker processes")
+    
+    # The embedding loop thread is already running, and forking a process that
+    # has threads can deadlock, so start workers from a forkserver where available
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+    mp_context = multiprocessing.get_context(start_method)
+    
+    # Files are submitted a bounded window at a time (enough to keep every worker
+    # busy), so finished extractions never pile up in memory ahead of embedding
+    extraction_window = max_workers * 2
+    queued = deque(pdf_files)
+    extracting: Deque[Tuple[Path, Future]] = deque()
+    # A crashed worker breaks the whole pool and fails every file in flight, so
+    # after a crash those files are re-run one at a time to find the one at fault
+    isolating = 0
+    file_index = 0
+    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+    
+    try:
+        while queued or extracting:
+            while queued and len(extracting) < (1 if isolating else extraction_window):
+                path = queued.popleft()
+                extracting.append((path, executor.submit(process_pdf, str(path))))
             
-            # Process each chunk
-            file_documents = []
-            for i, chunk in enumerate(chunks):
-                print(f"🔄 Processing chunk {i+1}/{len(chunks)}...")
+            file_path, extraction = extracting.popleft()
+            ran_alone = isolating > 0
+            isolating = max(isolating - 1, 0)
+            
+            try:
+                try:
+                    metadata, chunks, windows, _ = extraction.result()
+                except BrokenProcessPool:
+                    executor.shutdown()
+                    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+                    if not ran_alone:
+                        # Any file in flight could have crashed the worker; retry them all
+                        suspects = [file_path] + [path for path, _ in extracting]
+                        extracting.clear()
+                        queued.extendleft(reversed(suspects))
+                        isolating = len(suspects)
+                        print(f"⚠️ A worker process crashed - retrying {len(suspects)} files one at a time")
+                        continue
+                    raise
                 
-                # Generate unique ID
-                chunk_suffix = f"_chunk{i}" if len(chunks) > 1 else "_single"
-                doc_id = hashlib.md5(f"{file_path.name}{chunk_suffix}".encode()).hexdigest()
+                file_index += 1
+                print(f"\n{'='*60}")
+                print(f"📄 Processing {file_index}/{len(pdf_files)}: {file_path.name}")
+                print(f"{'='*60}")
                 
-                # Generate embeddings
-                embeddings = get_embeddings(chunk, openai_client, embedding_model)
-                if not embeddings:
-                    print(f"⚠️ Skipping chunk {i+1} - no embeddings generated")
+                if not chunks:
+                    print(f"⚠️ Skipping {file_path.name} - no text extracted")
                     continue
                 
-                # Create document for index
-                if len(chunks) > 1:
-                    title_suffix = f" (Part {i+1}/{len(chunks)})"
-                    summary = f"Part {i+1} of {len(chunks)} from {file_path.name}"
-                else:
-                    title_suffix = ""
-                    summary = f"Complete content from {file_path.name}"
+                print(f"🏷️ Classified as: {metadata['document_type']} from {metadata['institution']}")
+                print(f"📦 Created {len(chunks)} chunks for processing")
                 
-                document = {
-                    'id': doc_id,
-                    'title': f"{file_path.name}{title_suffix}",
-                    'content': chunk,
-                    'summary': summary,
-                    'document_type': metadata['document_type'],
-                    'institution': metadata['institution'], 
-                    'year': metadata['year'],
-                    'file_format': 'PDF',
-                    'tags': metadata['tags'],
-                    'chunk_index': i,
-                    'total_chunks': len(chunks),
-                    'file_path': str(file_path),
-                    'file_size': file_path.stat().st_size,
-                    'created_date': datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-                    'relevance_score': len(chunk.split()) / 1000.0,
-                    'content_vector': embeddings
-                }
+                if args.batch:
+                    pending_files.append((file_path, metadata, chunks, windows))
+                    print(f"📥 Queued {len(chunks)} chunks for the batch embedding job")
+                    continue
                 
-                file_documents.append(document)
-                print(f"✅ Created document for chunk {i+1}")
+                # Start embedding this file in the background and move on to the next PDF
+                future = asyncio.run_coroutine_threadsafe(get_cached_embeddings(
+                    chunks, windows, async_openai_client, embedding_model,
+                    embedding_cache, embedding_semaphore
+                ), embedding_loop)
+                embedding_futures[future] = (file_path, metadata, chunks)
+                del chunks, windows
                 
-                # Memory cleanup every few chunks
-                if (i + 1) % 5 == 0:
-                    gc.collect()
-            
-            all_documents.extend(file_documents)
-            processed_files += 1
-            
-            print(f"✅ Completed {file_path.name}: {len(file_documents)} chunks ready for upload")
-            print(f"📊 Progress: {processed_files}/{len(pdf_files)} files processed")
-            
-            # Memory cleanup after each file
-            gc.collect()
-            
-        except Exception as e:
-            print(f"❌ Error processing {file_path.name}: {e}")
-            continue
+                # Finish files that are already embedded, and cap how many are in flight
+                for done_future in [f for f in embedding_futures if f.done()]:
+                    finish_embedded_file(done_future)
+                while len(embedding_futures) >= EMBEDDING_FILES_IN_FLIGHT:
+                    done, _ = wait(list(embedding_futures), return_when=FIRST_COMPLETED)
+                    for done_future in done:
+                        finish_embedded_file(done_future)
+                
+            except BrokenProcessPool:
+                file_index += 1
+                print(f"❌ Error processing {file_path.name}: worker process crashed")
+                continue
+            except Exception as e:
+                print(f"❌ Error processing {file_path.name}: {e}")
+                continue
+    finally:
+        executor.shutdown()
     
-    # Upload all documents in batches
-    if all_documents:
+    # Finish the files still being embedded
+    while embedding_futures:
+        done, _ = wait(list(embedding_futures), return_when=FIRST_COMPLETED)
+        for done_future in done:
+            finish_embedded_file(done_future)
+    
+    # Embed everything queued in --batch mode with one Batch API job
+    if pending_files:
+        all_chunks = [chunk for _, _, chunks, _ in pending_files for chunk in chunks]
+        all_windows = [window for _, _, _, windows in pending_files for window in windows]
+        
         print(f"\n{'='*60}")
-        print(f"📤 UPLOADING {len(all_documents)} DOCUMENT CHUNKS TO INDEX")
+        print(f"📦 EMBEDDING {len(all_chunks)} CHUNKS WITH THE BATCH API")
         print(f"{'='*60}")
         
-        batch_size = 5  # Conservative batch size for PDFs
-        total_uploaded = 0
+        all_embeddings = get_embeddings_via_batch_api(
+            all_chunks, all_windows, openai_client, embedding_model, embedding_cache
+        )
         
-        for i in range(0, len(all_documents), batch_size):
-            batch = all_documents[i:i + batch_size]
-            batch_num = (i // batch_size) + 1
-            total_batches = (len(all_documents) + batch_size - 1) // batch_size
+        offset = 0
+        for file_path, metadata, chunks, _ in pending_files:
+            chunk_embeddings = all_embeddings[offset:offset + len(chunks)]
+            offset += len(chunks)
             
-            print(f"📤 Uploading batch {batch_num}/{total_batches} ({len(batch)} chunks)...")
+            file_documents = build_file_documents(file_path, metadata, chunks, chunk_embeddings)
+            upload_futures.extend(submit_document_uploads(upload_executor, search_client, file_documents))
+            total_documents += len(file_documents)
+            total_skipped += len(chunks) - len(file_documents)
+            processed_files += 1
+            print(f"✅ Completed {file_path.name}: {len(file_documents)} chunks queued for upload")
+            del file_documents, chunk_embeddings
             
-            try:
-                result = search_client.upload_documents(documents=batch)
-                
-                success_count = sum(1 for r in result if r.succeeded)
-                error_count = len(batch) - success_count
-                total_uploaded += success_count
-                
-                if error_count > 0:
-                    print(f"⚠️ Batch {batch_num}: {success_count} succeeded, {error_count} failed")
-                    for r in result:
-                        if not r.succeeded:
-                            print(f"   ❌ Error: {r.error_message}")
-                else:
-                    print(f"✅ Batch {batch_num}: All {success_count} chunks uploaded successfully")
-                    
-                gc.collect()  # Memory cleanup after each batch
-                    
-            except Exception as e:
-                print(f"❌ Error uploading batch {batch_num}: {e}")
-        
+            total_uploaded += collect_uploads(upload_futures, MAX_PENDING_UPLOADS)
+    
+    # Wait for the remaining uploads
+    total_uploaded += collect_uploads(upload_futures)
+    upload_executor.shutdown()
+    
+    if total_documents:
         print(f"\n🎉 UPLOAD COMPLETED!")
         print(f"📊 Final Summary:")
         print(f"   📄 PDF files processed: {processed_files}/{len(pdf_files)}")
-        print(f"   📚 Total chunks uploaded: {total_uploaded}/{len(all_documents)}")
+        print(f"   📚 Total chunks uploaded: {total_uploaded}/{total_documents + total_skipped}")
         print(f"   🏦 Index: {INDEX_NAME}")
         print(f"   🔍 Ready for ESG research queries!")
         
-        if total_uploaded < len(all_documents):
-            failed_count = len(all_documents) - total_uploaded
+        if total_uploaded < total_documents:
+            failed_count = total_documents - total_uploaded
             print(f"   ⚠️ {failed_count} chunks failed to upload - check logs above")
     else:
         print("❌ No documents to upload - all PDFs failed processing")
     
+    if total_skipped:
+        print(f"   ⚠️ {total_skipped} chunks skipped - no embeddings generated, check logs above")
+    
     # Final cleanup
-    gc.collect()
+    embedding_cache.close()
+    asyncio.run_coroutine_threadsafe(async_openai_client.close(), embedding_loop).result()
+    get_async_openai_client.cache_clear()  # a closed client must not be handed to the next run
+    embedding_loop.call_soon_threadsafe(embedding_loop.stop)
+    embedding_thread.join()
+    embedding_loop.close()
     print("\n🎉 ESG PDF indexing completed!")
     print("💡 You can now run your multi-agent research queries!")
 